@@ -1,65 +1,222 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import functools
 import json
 import re
-import markdown2
+import mistune
+import orjson
 import requests # <-- Added
 import os # <-- Added
 import sys # <-- Added
-from flask import Flask, render_template, url_for, request, jsonify, abort, redirect
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, render_template, url_for, request, jsonify, abort, redirect, make_response
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
+
+class OrjsonProvider(JSONProvider):
+    """Backs jsonify and request.json with orjson, which is 2-5x faster
+    than stdlib json and serializes straight to bytes."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Compress HTML/JSON responses; lesson pages carry long rendered markdown.
+# Replies under 500 bytes (tiny JSON feedback) aren't worth compressing.
+app.config["COMPRESS_MIN_SIZE"] = 500
+Compress(app)
 
 # --- Centralized AI Model ---
 AI_MODEL = "mistralai/mistral-7b-instruct:free"
 
+# --- Summary prompts ---
+SYSTEM_PROMPT_STUDENT = "You are a helpful and encouraging assistant for a student. Briefly summarize the student's upcoming lessons for the day in one friendly and concise sentence (around 20-25 words)."
+SYSTEM_PROMPT_TEACHER = "You are a helpful assistant for a teacher. Concisely summarize the class status and upcoming topics in one or two brief sentences for a 'Today at a glance' section."
+
+def _load_api_key():
+    """Reads the OpenRouter API key from the environment or openrouter_key.txt."""
+    api_key = os.environ.get("OPENROUTER_API_KEY")
+    if api_key:
+        return api_key
+    try:
+        with open('openrouter_key.txt', 'r') as keyfile:
+            return keyfile.read().strip()
+    except FileNotFoundError:
+        return None
+
+API_KEY = _load_api_key()
+AI_ENABLED = API_KEY is not None
+if not AI_ENABLED:
+    print("OPENROUTER_API_KEY not set and openrouter_key.txt not found; AI features disabled.", file=sys.stderr)
+
+# Markdown renderer shared across requests; escape=False keeps the inline
+# <input>/<textarea> tags that lessons embed for answers.
+MD = mistune.create_markdown(escape=False, plugins=["strikethrough", "table"])
+
+# --- Shared HTTP session for OpenRouter calls ---
+# One pooled session keeps TLS connections alive between LLM calls instead of
+# paying a fresh TCP + TLS handshake on every request.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# Worker pool for fanning out LLM grading calls; each call is I/O-bound, and
+# 8 workers stays comfortably under OpenRouter's rate limits.
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
 # --- Corrected File Paths ---
 DATA_PATH = Path(__file__).parent / "data"
 LESSONS_PATH = DATA_PATH / "lessons"  # This now correctly points to the directory
 
 # --- Helper and Parsing Functions ---
 
+# Precompiled patterns shared by the helpers below.
+_SLUG_RE = re.compile(r'[^a-z0-9]+')
+_TITLE_RE = re.compile(r'###\s*(.*)')
+
+@functools.lru_cache(maxsize=1)
 def load_data():
-    """Loads static data like brand and user info."""
-    with open(DATA_PATH / "seed.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    """Loads static data like brand and user info (parsed once per process).
 
-def slugify(title):
-    """Converts a string to a URL-friendly slug."""
-    return re.sub(r'[^a-z0-9]+', '-', title.lower()).strip('-')
+    The returned dict is shared by every request, so treat it as read-only.
+    Anything derived from the seed data (slugs, sorted views) belongs here,
+    not in the routes.
+    """
+    with open(DATA_PATH / "seed.json", "rb") as f:
+        data = orjson.loads(f.read())
 
-def parse_lesson_file(slug):
-    """Gets lesson data from its specific JSON file and returns HTML content."""
+    for item in data["student"]["lessons"] + data["teacher"]["plans"]:
+        item["slug"] = slugify(item["title"])
+
+    data["student"]["lessons_sorted"] = sorted(
+        data["student"]["lessons"], key=lambda x: x["stars"], reverse=True)
+
+    # User prompts for the two summary routes only depend on the seed data,
+    # so build the strings once here instead of per request.
+    s = data["student"]
+    lesson_titles = ", ".join([l['title'] for l in s["lessons"]])
+    s["summary_user_prompt"] = f"My lessons for today are: {lesson_titles}. Please give me a one-sentence summary of what I'll be learning."
+
+    t = data["teacher"]
+    student_statuses = [student['status'] for student in t['students']]
+    status_counts = {
+        "good": student_statuses.count('good'),
+        "warn": student_statuses.count('warn'),
+        "bad": student_statuses.count('bad')
+    }
+    upcoming_plans = ", ".join([p['title'] for p in t['plans'][:2]])
+    t["summary_user_prompt"] = (
+        f"Here is a summary of my class: "
+        f"{status_counts['good']} students are on track, "
+        f"{status_counts['warn']} students need watching, and "
+        f"{status_counts['bad']} students need help. "
+        f"The next lesson plans are: {upcoming_plans}. "
+        f"Please provide a very brief summary."
+    )
+
+    return data
+
+# Parsed lesson JSONs keyed by slug; entries are (mtime, lesson_dict) so a
+# teacher saving a lesson invalidates the cache automatically.
+_LESSON_CACHE = {}
+
+def read_lesson_file(slug):
+    """Reads a lesson's JSON file, reusing the cached parse while the file is unchanged."""
     lesson_file = LESSONS_PATH / f"{slug}.json"
     if not lesson_file.exists():
-        return None, None, None
+        return None
 
-    with open(lesson_file, "r", encoding="utf-8") as f:
-        lesson = json.load(f)
+    mtime = lesson_file.stat().st_mtime
+    cached = _LESSON_CACHE.get(slug)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
 
-    title = lesson.get("title", "Lesson")
-    markdown_content = lesson.get("markdown_content", "")
-    answer_key = lesson.get("answer_key", {})
+    with open(lesson_file, "rb") as f:
+        lesson = orjson.loads(f.read())
+    _LESSON_CACHE[slug] = (mtime, lesson)
+    return lesson
+
+def write_lesson_file(lesson_file, lesson_data):
+    """Writes a lesson JSON atomically so a crash mid-write can't corrupt it."""
+    tmp = lesson_file.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(lesson_data, indent=2), encoding="utf-8")
+    os.replace(tmp, lesson_file)
 
-    # Remove the H3 title from the markdown before rendering to HTML
-    title_match = re.search(r'###\s*(.*)', markdown_content)
+def write_lesson_html(html_file, html_content):
+    """Writes a lesson's HTML sidecar atomically, like write_lesson_file.
+
+    A torn sidecar would be worse than a torn JSON: its fresher mtime would
+    keep the corrupt HTML serving until the next save.
+    """
+    tmp = html_file.with_suffix(".html.tmp")
+    tmp.write_text(html_content, encoding="utf-8")
+    os.replace(tmp, html_file)
+
+def slugify(title):
+    """Converts a string to a URL-friendly slug."""
+    return _SLUG_RE.sub('-', title.lower()).strip('-')
+
+def render_lesson_html(markdown_content):
+    """Renders lesson markdown to HTML, dropping the H3 title line first."""
+    title_match = _TITLE_RE.search(markdown_content)
     if title_match:
         content_for_html = markdown_content[title_match.end():].strip()
     else:
         content_for_html = markdown_content
-    
-    html_content = markdown2.markdown(content_for_html)
+    return MD(content_for_html)
+
+def parse_lesson_file(slug):
+    """Gets lesson data from its specific JSON file and returns HTML content."""
+    lesson = read_lesson_file(slug)
+    if lesson is None:
+        return None, None, None
+
+    title = lesson.get("title", "Lesson")
+    answer_key = lesson.get("answer_key", {})
+    html_content = lesson.get("html_content")
+
+    if html_content is None:
+        # Lesson saved before HTML precompilation: render once and write the
+        # HTML back so future reads skip the markdown parser entirely.
+        html_content = render_lesson_html(lesson.get("markdown_content", ""))
+        lesson["html_content"] = html_content
+        lesson_file = LESSONS_PATH / f"{slug}.json"
+        write_lesson_file(lesson_file, lesson)
+        _LESSON_CACHE[slug] = (lesson_file.stat().st_mtime, lesson)
 
     return title, html_content, answer_key
 
+def read_lesson_html(slug):
+    """Returns a lesson's rendered HTML from its .html sidecar file.
+
+    The sidecar keeps the lesson GET down to a single small file read. It is
+    regenerated whenever it is missing or older than the lesson JSON.
+    """
+    html_file = LESSONS_PATH / f"{slug}.html"
+    lesson_file = LESSONS_PATH / f"{slug}.json"
+    if html_file.exists() and html_file.stat().st_mtime >= lesson_file.stat().st_mtime:
+        return html_file.read_text(encoding="utf-8")
+
+    _, html_content, _ = parse_lesson_file(slug)
+    if html_content is not None:
+        write_lesson_html(html_file, html_content)
+    return html_content
+
 def parse_raw_lesson_file(slug):
     """Gets raw lesson data from its specific JSON file for the edit page."""
-    lesson_file = LESSONS_PATH / f"{slug}.json"
-    if not lesson_file.exists():
+    lesson = read_lesson_file(slug)
+    if lesson is None:
         return None, None, None
 
-    with open(lesson_file, "r", encoding="utf-8") as f:
-        lesson = json.load(f)
-
     title = lesson.get("title", "Lesson")
     markdown_content = lesson.get("markdown_content", "")
     answer_key = lesson.get("answer_key", {})
@@ -68,26 +225,30 @@ def parse_raw_lesson_file(slug):
 
     return title, markdown_content, json_string
 
+# Completed summaries keyed by (system_prompt, user_prompt). The prompts are
+# prebuilt from the static seed data, so identical requests can reuse the
+# first LLM response for the life of the process.
+_SUMMARY_CACHE = {}
+
 def generate_ai_summary(system_prompt, user_prompt, fallback_summary="Here is your summary for the day."):
     """Generates a summary using an AI model from Openrouter."""
+    if not AI_ENABLED:
+        return fallback_summary
+
+    cache_key = (system_prompt, user_prompt)
+    cached = _SUMMARY_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
     print('Making summary request to Openrouter')
-    api_key = os.environ.get("OPENROUTER_API_KEY")
-    if not api_key:
-        try:
-            with open('openrouter_key.txt', 'r') as keyfile:
-                api_key = keyfile.read().strip()
-        except FileNotFoundError:
-            print("AI summary generation skipped: API key file not found.", file=sys.stderr)
-            return fallback_summary
 
     try:
-        response = requests.post(
+        response = SESSION.post(
             url="https://openrouter.ai/api/v1/chat/completions",
             headers={
-                "Authorization": f"Bearer {api_key}",
+                "Authorization": f"Bearer {API_KEY}",
                 "Content-Type": "application/json"
             },
-            data=json.dumps({
+            data=orjson.dumps({
                 "model": AI_MODEL,
                 "messages": [
                     {"role": "system", "content": system_prompt},
@@ -105,6 +266,7 @@ def generate_ai_summary(system_prompt, user_prompt, fallback_summary="Here is yo
         # Clean up potential quotation marks from the response
         if summary.startswith('"') and summary.endswith('"'):
             summary = summary[1:-1]
+        _SUMMARY_CACHE[cache_key] = summary
         return summary
     except requests.exceptions.RequestException as e:
         print(f"AI summary API request failed: {e}", file=sys.stderr)
@@ -116,17 +278,49 @@ def generate_ai_summary(system_prompt, user_prompt, fallback_summary="Here is yo
         print(f"An unexpected error occurred during AI summary generation: {e}", file=sys.stderr)
         return fallback_summary
 
+def grade_deterministic(rule, user_answer):
+    """Grades an exact-match, numeric, or contains rule without any I/O."""
+    if rule.get("type") == "exact-match":
+        correct_answer = rule.get("answer", "")
+        return user_answer.strip().lower() == correct_answer.strip().lower()
+
+    if "numeric" in rule:
+        try:
+            user_num = float(user_answer)
+            correct_num = float(rule["numeric"])
+            tolerance = float(rule.get("tolerance", 0.0))
+            return abs(user_num - correct_num) <= tolerance
+        except (ValueError, TypeError):
+            return False
+
+    if "contains" in rule:
+        keywords = rule.get("contains", [])
+        min_matches = rule.get("min", 1)
+        matches = sum(1 for keyword in keywords if keyword.lower() in user_answer.lower())
+        return matches >= min_matches
+
+    return False
+
+# Grading verdicts keyed by (question, normalized answer, expected answer).
+# Students often resubmit the same text while iterating on a lesson, and
+# re-grading identical input costs a full LLM round-trip.
+_GRADE_CACHE = {}
+_GRADE_CACHE_MAX = 4096
+
 def grade_with_llm(question, student_answer, expected_answer):
     """Uses an LLM to check if the student's answer is correct."""
+    if not AI_ENABLED:
+        return False # Default to incorrect if API key is missing
+
+    cache_key = (question, " ".join(student_answer.lower().split()), expected_answer)
+    # Single pop with a default: this runs concurrently across the executor
+    # and server threads, so a check-then-pop would race. Verdicts are bools,
+    # never None. Re-inserting on hit keeps hot entries at the recent end.
+    verdict = _GRADE_CACHE.pop(cache_key, None)
+    if verdict is not None:
+        _GRADE_CACHE[cache_key] = verdict
+        return verdict
     print(f"Grading with LLM for question: {question}")
-    api_key = os.environ.get("OPENROUTER_API_KEY")
-    if not api_key:
-        try:
-            with open('openrouter_key.txt', 'r') as keyfile:
-                api_key = keyfile.read().strip()
-        except FileNotFoundError:
-            print("LLM grading skipped: API key file not found.", file=sys.stderr)
-            return False # Default to incorrect if API key is missing
 
     system_prompt = """
     You are a fair and helpful AI teaching assistant. Your goal is to grade a student's answer based on their conceptual understanding.
@@ -146,10 +340,10 @@ def grade_with_llm(question, student_answer, expected_answer):
     """
     
     try:
-        response = requests.post(
+        response = SESSION.post(
             url="https://openrouter.ai/api/v1/chat/completions",
-            headers={"Authorization": f"Bearer {api_key}"},
-            data=json.dumps({
+            headers={"Authorization": f"Bearer {API_KEY}"},
+            data=orjson.dumps({
                 "model": AI_MODEL,
                 "messages": [
                     {"role": "system", "content": system_prompt},
@@ -164,7 +358,15 @@ def grade_with_llm(question, student_answer, expected_answer):
         ai_response = response.json()
         result = ai_response['choices'][0]['message']['content'].strip().lower()
         print(f"LLM Grader response: {result}")
-        return result == "correct"
+        is_correct = result == "correct"
+        # Only successful verdicts are cached; transient API errors below
+        # should stay retryable. At capacity, evict the least recently used
+        # entry (dicts are insertion-ordered) rather than the whole cache;
+        # the pop default covers another thread evicting the same key first.
+        if len(_GRADE_CACHE) >= _GRADE_CACHE_MAX:
+            _GRADE_CACHE.pop(next(iter(_GRADE_CACHE)), None)
+        _GRADE_CACHE[cache_key] = is_correct
+        return is_correct
     except Exception as e:
         print(f"An error occurred during LLM grading: {e}", file=sys.stderr)
         return False # Default to incorrect on error
@@ -181,56 +383,74 @@ def login():
         star_score=None,
     )
 
+def _cacheable(response, etag):
+    """Marks a response revalidatable so repeat views can 304 instead of re-rendering.
+
+    The ETag is weak because flask-compress rewrites strong ETags to
+    '<etag>:gzip' on compressed responses; a strong validator would never
+    match what the browser sends back, leaving the in-route 304 check dead.
+    """
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, max-age=60, must-revalidate"
+    return response
+
 @app.route("/student")
 def student():
     data = load_data()
     s = data["student"]
-    lessons_with_slugs = []
-    for lesson in s["lessons"]:
-        lesson['slug'] = slugify(lesson['title'])
-        lessons_with_slugs.append(lesson)
-    
-    lessons = sorted(lessons_with_slugs, key=lambda x: x["stars"], reverse=True)
-    
-    return render_template(
+
+    # The page only changes when seed.json does, so its mtime works as an ETag.
+    etag = str(int((DATA_PATH / "seed.json").stat().st_mtime))
+    if request.if_none_match.contains_weak(etag):
+        # A 304 must echo the validator, or caches may drop the stored ETag.
+        return _cacheable(make_response("", 304), etag)
+
+    response = make_response(render_template(
         "student.html",
         brand=data["brand"],
         avatar_initials=s.get("initials", "S"),
         star_score=s.get("star_score", 0),
         summary="Loading summary...",
-        lessons=lessons,
-    )
+        lessons=s["lessons_sorted"],
+    ))
+    return _cacheable(response, etag)
 
 @app.route("/student/generate-summary")
 def generate_student_summary():
     """Generates and returns the student AI summary."""
     data = load_data()
     s = data["student"]
-    lesson_titles = ", ".join([l['title'] for l in s["lessons"]])
-    system_prompt_student = "You are a helpful and encouraging assistant for a student. Briefly summarize the student's upcoming lessons for the day in one friendly and concise sentence (around 20-25 words)."
-    user_prompt_student = f"My lessons for today are: {lesson_titles}. Please give me a one-sentence summary of what I'll be learning."
-    
     fallback_summary = s.get("summary", "Here are your lessons for today!")
-    ai_summary = generate_ai_summary(system_prompt_student, user_prompt_student, fallback_summary)
+    ai_summary = generate_ai_summary(SYSTEM_PROMPT_STUDENT, s["summary_user_prompt"], fallback_summary)
     return jsonify({"summary": ai_summary})
 
 @app.route("/lesson/<lesson_slug>")
 def lesson(lesson_slug):
     data = load_data()
     s = data["student"]
-    title, content, _ = parse_lesson_file(lesson_slug)
+    lesson_data = read_lesson_file(lesson_slug)
 
-    if title is None:
+    if lesson_data is None:
         abort(404, description="Lesson not found")
 
-    return render_template(
+    # Content only changes on teacher save, so the JSON's mtime works as an ETag.
+    etag = str(int((LESSONS_PATH / f"{lesson_slug}.json").stat().st_mtime))
+    if request.if_none_match.contains_weak(etag):
+        # A 304 must echo the validator, or caches may drop the stored ETag.
+        return _cacheable(make_response("", 304), etag)
+
+    title = lesson_data.get("title", "Lesson")
+    content = read_lesson_html(lesson_slug)
+
+    response = make_response(render_template(
         "lesson.html",
         brand=data["brand"],
         avatar_initials=s.get("initials", "S"),
         star_score=s.get("star_score", 0),
         lesson_title=title,
         lesson_content=content
-    )
+    ))
+    return _cacheable(response, etag)
 
 @app.route("/lesson/<lesson_slug>/submit", methods=["POST"])
 def submit_lesson(lesson_slug):
@@ -244,7 +464,11 @@ def submit_lesson(lesson_slug):
             "message": "Answer key not found."
         }), 404
 
+    # First pass: grade everything deterministic and set aside llm-check
+    # questions, so submissions without open-ended answers return without
+    # touching the LLM path at all.
     feedback = {}
+    llm_items = []
     for question_id, user_answer in answers.items():
         if question_id == 'student_question': continue # Ignore the AI help question
         rule = answer_key.get(question_id)
@@ -252,37 +476,23 @@ def submit_lesson(lesson_slug):
             feedback[question_id] = "no-rule"
             continue
 
-        is_correct = False
-        grading_type = rule.get("type")
+        if rule.get("type") == "llm-check":
+            llm_items.append((question_id, rule, user_answer))
+            continue
 
-        if grading_type == "exact-match":
-            correct_answer = rule.get("answer", "")
-            is_correct = user_answer.strip().lower() == correct_answer.strip().lower()
+        feedback[question_id] = "correct" if grade_deterministic(rule, user_answer) else "incorrect"
 
-        elif grading_type == "llm-check":
-            question_text = rule.get("question_text", "")
-            expected_answer = rule.get("expected_answer", "")
-            is_correct = grade_with_llm(question_text, user_answer, expected_answer)
-        
-        elif "numeric" in rule:
-            try:
-                user_num = float(user_answer)
-                correct_num = float(rule["numeric"])
-                tolerance = float(rule.get("tolerance", 0.0))
-                if abs(user_num - correct_num) <= tolerance:
-                    is_correct = True
-            except (ValueError, TypeError):
-                is_correct = False
-        
-        elif "contains" in rule:
-            keywords = rule.get("contains", [])
-            min_matches = rule.get("min", 1)
-            matches = sum(1 for keyword in keywords if keyword.lower() in user_answer.lower())
-            if matches >= min_matches:
-                is_correct = True
-        
+    if not llm_items:
+        return jsonify({"status": "success", "feedback": feedback})
+
+    # Second pass: fan the remaining llm-check grades out across the pool.
+    results = LLM_EXECUTOR.map(
+        lambda item: grade_with_llm(
+            item[1].get("question_text", ""), item[2], item[1].get("expected_answer", "")),
+        llm_items)
+    for (question_id, _, _), is_correct in zip(llm_items, results):
         feedback[question_id] = "correct" if is_correct else "incorrect"
-    
+
     return jsonify({"status": "success", "feedback": feedback})
 
 
@@ -290,11 +500,6 @@ def submit_lesson(lesson_slug):
 def teacher():
     data = load_data()
     t = data["teacher"]
-    plans_with_slugs = []
-    for plan in t["plans"]:
-        plan['slug'] = slugify(plan['title'])
-        plans_with_slugs.append(plan)
-        
     return render_template(
         "teacher.html",
         brand=data["brand"],
@@ -302,7 +507,7 @@ def teacher():
         star_score=None,
         summary="Loading summary...",
         students=t["students"],
-        plans=plans_with_slugs,
+        plans=t["plans"],
     )
 
 @app.route("/teacher/generate-summary")
@@ -310,27 +515,8 @@ def generate_teacher_summary():
     """Generates and returns the teacher AI summary."""
     data = load_data()
     t = data["teacher"]
-    
-    student_statuses = [s['status'] for s in t['students']]
-    status_counts = {
-        "good": student_statuses.count('good'),
-        "warn": student_statuses.count('warn'),
-        "bad": student_statuses.count('bad')
-    }
-    upcoming_plans = ", ".join([p['title'] for p in t['plans'][:2]])
-
-    system_prompt_teacher = "You are a helpful assistant for a teacher. Concisely summarize the class status and upcoming topics in one or two brief sentences for a 'Today at a glance' section."
-    user_prompt_teacher = (
-        f"Here is a summary of my class: "
-        f"{status_counts['good']} students are on track, "
-        f"{status_counts['warn']} students need watching, and "
-        f"{status_counts['bad']} students need help. "
-        f"The next lesson plans are: {upcoming_plans}. "
-        f"Please provide a very brief summary."
-    )
-    
     fallback_summary = "Review student performance and manage your lesson plans for the day."
-    ai_summary = generate_ai_summary(system_prompt_teacher, user_prompt_teacher, fallback_summary)
+    ai_summary = generate_ai_summary(SYSTEM_PROMPT_TEACHER, t["summary_user_prompt"], fallback_summary)
     return jsonify({"summary": ai_summary})
 
 @app.route("/teacher/lesson/<lesson_slug>/edit")
@@ -363,11 +549,11 @@ def save_lesson(lesson_slug):
         abort(400, "Missing content.")
 
     try:
-        answer_key = json.loads(answer_key_json)
+        answer_key = orjson.loads(answer_key_json)
     except json.JSONDecodeError:
         abort(400, "Invalid JSON format for answer key.")
 
-    title_match = re.search(r'###\s*(.*)', markdown_content)
+    title_match = _TITLE_RE.search(markdown_content)
     title = title_match.group(1).strip() if title_match else "Untitled Lesson"
     
     lesson_file = LESSONS_PATH / f"{lesson_slug}.json"
@@ -377,11 +563,13 @@ def save_lesson(lesson_slug):
     lesson_data = {
         "title": title,
         "markdown_content": markdown_content.strip(),
+        "html_content": render_lesson_html(markdown_content),
         "answer_key": answer_key
     }
     
-    with open(lesson_file, "w", encoding="utf-8") as f:
-        json.dump(lesson_data, f, indent=2)
+    write_lesson_file(lesson_file, lesson_data)
+    # Refresh the rendered-HTML sidecar served by the lesson route.
+    write_lesson_html(LESSONS_PATH / f"{lesson_slug}.html", lesson_data["html_content"])
 
     return redirect(url_for('teacher'))
     
@@ -389,21 +577,91 @@ def save_lesson(lesson_slug):
 def preview_lesson():
     """Renders markdown from a POST request and returns the HTML."""
     markdown_text = request.form.get('markdown_text', '')
-    content_without_title = re.sub(r'###\s*(.*)', '', markdown_text, 1)
-    html = markdown2.markdown(content_without_title)
+    content_without_title = _TITLE_RE.sub('', markdown_text, 1)
+    html = MD(content_without_title)
     return html
 
+# Timeout for lesson generation, the longest-running LLM call we make.
+_GENERATE_TIMEOUT = (5, 45)
+
+def _stream_completion_content(payload):
+    """Streams a chat completion and returns the accumulated content.
+
+    Reading the SSE stream lets us stop as soon as a depth-balanced JSON
+    object has arrived instead of buffering whatever prose the model tacks
+    on afterwards, which keeps slow generations under gateway time limits.
+    """
+    chunks = []
+    depth = 0
+    seen_brace = False
+    in_string = False
+    escaped = False
+    with SESSION.post(
+        url="https://openrouter.ai/api/v1/chat/completions",
+        headers={ "Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json" },
+        data=orjson.dumps({**payload, "stream": True}),
+        timeout=_GENERATE_TIMEOUT,
+        stream=True,
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            try:
+                delta = orjson.loads(data)['choices'][0].get('delta', {}).get('content')
+            except (json.JSONDecodeError, KeyError, IndexError):
+                continue
+            if not delta:
+                continue
+            chunks.append(delta)
+            # Track string/escape state so braces inside JSON string values
+            # (e.g. code snippets in markdown_content) don't count as nesting
+            # and end the stream early.
+            for char in delta:
+                if escaped:
+                    escaped = False
+                elif in_string:
+                    if char == '\\':
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char == '{':
+                    depth += 1
+                    seen_brace = True
+                elif char == '}':
+                    depth -= 1
+            if seen_brace and not in_string and depth <= 0:
+                break
+    return "".join(chunks)
+
+def _parse_lesson_json(content):
+    """Parses the lesson JSON object from a model response, or None.
+
+    With response_format=json_object the content is bare JSON; the fenced-
+    block fallback only covers models that ignore JSON mode.
+    """
+    try:
+        return orjson.loads(content)
+    except json.JSONDecodeError:
+        pass
+    json_match = re.search(r'```json\s*(\{.*?\})\s*```', content, re.DOTALL)
+    json_string = json_match.group(1) if json_match else content[content.find('{'):content.rfind('}')+1]
+    try:
+        return orjson.loads(json_string)
+    except json.JSONDecodeError:
+        return None
+
 @app.route("/teacher/lesson/generate-with-ai", methods=["POST"])
 def generate_with_ai():
     """Generates lesson content using an AI model from Openrouter."""
-    api_key = os.environ.get("OPENROUTER_API_KEY")
-    if not api_key:
-        try:
-            with open('openrouter_key.txt', 'r') as keyfile:
-                api_key = keyfile.read().strip()
-        except:
-            return jsonify({"error": "OPENROUTER_API_KEY environment variable not set."}), 500
-        
+    if not AI_ENABLED:
+        return jsonify({"error": "OPENROUTER_API_KEY environment variable not set."}), 500
+
     user_prompt = request.form.get('prompt')
     markdown_content = request.form.get('markdown_content')
     answer_key_json = request.form.get('answer_key_json')
@@ -431,26 +689,38 @@ def generate_with_ai():
     Please provide the updated lesson content in the specified JSON format.
     """
     
+    payload = {
+        "model": AI_MODEL,
+        "messages": [ { "role": "system", "content": system_prompt }, { "role": "user", "content": full_prompt } ],
+        "max_tokens": 1024,
+        "temperature": 0.2,
+        "response_format": {"type": "json_object"},
+    }
+
     try:
-        response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
-            headers={ "Authorization": f"Bearer {api_key}", "Content-Type": "application/json" },
-            data=json.dumps({
-                "model": AI_MODEL, 
-                "messages": [ { "role": "system", "content": system_prompt }, { "role": "user", "content": full_prompt } ]
-            })
-        )
-        response.raise_for_status()
-        ai_response = response.json()
-        content = ai_response['choices'][0]['message']['content']
-        json_match = re.search(r'```json\s*(\{.*?\})\s*```', content, re.DOTALL)
-        json_string = json_match.group(1) if json_match else content[content.find('{'):content.rfind('}')+1]
-        parsed_json = json.loads(json_string)
+        content = _stream_completion_content(payload)
+        parsed_json = _parse_lesson_json(content)
+
+        if parsed_json is None:
+            # The stream cut off early or the model wrapped the JSON oddly;
+            # retry once with a plain buffered request.
+            response = SESSION.post(
+                url="https://openrouter.ai/api/v1/chat/completions",
+                headers={ "Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json" },
+                data=orjson.dumps(payload),
+                timeout=_GENERATE_TIMEOUT,
+            )
+            response.raise_for_status()
+            content = response.json()['choices'][0]['message']['content']
+            parsed_json = _parse_lesson_json(content)
+
+        if parsed_json is None:
+            return jsonify({"error": "Failed to parse AI response. The response may be invalid."}), 500
         return jsonify(parsed_json)
 
     except requests.exceptions.RequestException as e:
         return jsonify({"error": f"API request failed: {e}"}), 500
-    except (json.JSONDecodeError, KeyError, IndexError):
+    except (KeyError, IndexError):
         return jsonify({"error": "Failed to parse AI response. The response may be invalid."}), 500
     except Exception as e:
         return jsonify({"error": f"An unexpected error occurred: {e}"}), 500
@@ -459,13 +729,8 @@ def generate_with_ai():
 @app.route("/lesson/ask-ai-for-help", methods=["POST"])
 def ask_ai_for_help():
     """Answers a student's question about the lesson content using an AI tutor model."""
-    api_key = os.environ.get("OPENROUTER_API_KEY")
-    if not api_key:
-        try:
-            with open('openrouter_key.txt', 'r') as keyfile:
-                api_key = keyfile.read().strip()
-        except FileNotFoundError:
-            return jsonify({"error": "AI feature is not configured."}), 500
+    if not AI_ENABLED:
+        return jsonify({"error": "AI feature is not configured."}), 500
 
     student_question = request.form.get('student_question')
     context = request.form.get('context') # The full lesson content
@@ -496,10 +761,10 @@ def ask_ai_for_help():
     """
 
     try:
-        response = requests.post(
+        response = SESSION.post(
             url="https://openrouter.ai/api/v1/chat/completions",
-            headers={ "Authorization": f"Bearer {api_key}", "Content-Type": "application/json" },
-            data=json.dumps({
+            headers={ "Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json" },
+            data=orjson.dumps({
                 "model": AI_MODEL,
                 "messages": [
                     {"role": "system", "content": system_prompt},
@@ -523,4 +788,7 @@ def ask_ai_for_help():
         return jsonify({"error": f"An unexpected error occurred: {e}"}), 500
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Local development server only. In production run a threaded WSGI
+    # server so concurrent LLM requests are actually concurrent, e.g.:
+    #   gunicorn -k gthread -w 2 --threads 16 app:app
+    app.run(debug=os.environ.get("FLASK_DEBUG", "1") == "1", threaded=True)